@@ -1,18 +1,35 @@
-import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
+import numba
+import numpy as np
+import orjson
 import pypdfium2 as pdfium
-from transformers import LayoutLMv3FeatureExtractor
-from PIL import Image, ImageDraw, ImageFont
+import pyvips
+from rapidocr_onnxruntime import RapidOCR
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 import utils
 
 
 def testDocquery():
+    import torch
     from docquery import document
     from docquery.transformers_patch import pipeline
 
-    p = pipeline('document-question-answering')
+    device = 0 if torch.cuda.is_available() else -1
+    p = pipeline('document-question-answering', device=device)
+    if device >= 0:
+        def floatLogits(module, inputs, outputs):
+            # the postprocess runs numpy on the logits, which does not support bf16
+            outputs.start_logits = outputs.start_logits.float()
+            outputs.end_logits = outputs.end_logits.float()
+            return outputs
+
+        # run the LayoutLM model in bf16 on the gpu with a compiled forward pass
+        p.model = torch.compile(p.model.to(dtype=torch.bfloat16), mode="reduce-overhead")
+        p.model.register_forward_hook(floatLogits)
     doc = document.load_document("./invoice_easy.pdf")
     questions = [
         "What is the invoice number?",
@@ -29,60 +46,138 @@ def testDocquery():
         "What is supplier address?",
     ]
 
-    for q in questions:
-        print(q, p(question=q, **doc.context))
+    questions = list(dict.fromkeys(questions))  # skip repeated questions, preserving order
+    # answer all the questions in a single batched pipeline call
+    answers = p([{"question": q, **doc.context} for q in questions], batch_size=len(questions))
+    for q, answer in zip(questions, answers):
+        print(q, answer)
 
 
-def convertDataset(dataset_dir: str, save_dir: str, overwrite: bool = False, **kwargs) -> None:
+def convertDataset(dataset_dir: str, save_dir: str, overwrite: bool = False, max_workers: int = os.cpu_count(),
+                   **kwargs) -> None:
     """
-    Convert a dataset of pdf documents to the desired image type.
+    Convert a dataset of pdf documents to the desired image type, the
+    documents are converted in parallel across processes.
 
     :param dataset_dir: Path to the dataset documents, should be a str
     :param save_dir: Save path for the converted documents, should be a str
     :param overwrite: Whether to overwrite the exiting files, should be a bool
+    :param max_workers: Number of documents to convert at once, should be an int
     :param kwargs: Keywords and values to be passed to convertPDF
     :return: None
     """
-    for document_dir in utils.listPath(dataset_dir, ext=['pdf', 'PDF'], return_file_path=True)[1]:
-        document_name = utils.getLastPath(document_dir)
-        pdf2png_path, exist = utils.checkPath(save_dir, "pdf2img", os.path.splitext(document_name)[0],
-                                              errors='ignore')
-        if not exist or overwrite:
-            print('converting document:', document_name)
-            convertPDF(document_dir, pdf2png_path, **kwargs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for document_dir in utils.listPath(dataset_dir, ext=['pdf', 'PDF'], return_file_path=True)[1]:
+            document_name = utils.getLastPath(document_dir)
+            pdf2png_path, exist = utils.checkPath(save_dir, "pdf2img", os.path.splitext(document_name)[0],
+                                                  errors='ignore')
+            if not exist or overwrite:
+                print('converting document:', document_name)
+                # documents already run in parallel, render the pages of each within its worker
+                futures.append(executor.submit(convertPDF, document_dir, pdf2png_path, n_processes=1, **kwargs))
+        for future in futures:
+            future.result()
     print('Documents have been converted and saved!')
 
 
-def convertPDF(document_dir: str, pdf2img_path: str, ext: str = 'png') -> None:
+def convertPDF(document_dir: str, pdf2img_path: str, ext: str = 'png', n_processes: int = os.cpu_count()) -> None:
     """
     Convert the pdf file into Images, to be saved as separate pages.
 
     :param document_dir: Path to pdf document, should be a str
     :param pdf2img_path: Path to save the converted pdfs, should be a str
     :param ext: Save the images with file extension, should be a str
+    :param n_processes: Number of processes used to render the pages, 1 renders in this process, should be an int
     :return: None
     """
     utils.makePath(pdf2img_path)
     pdf = pdfium.PdfDocument(document_dir)
     page_indices = [i for i in range(len(pdf))]
-    renderer = pdf.render_to(pdfium.BitmapConv.pil_image, page_indices=page_indices)
+    if n_processes > 1:
+        renderer = pdf.render_to(pdfium.BitmapConv.pil_image, page_indices=page_indices, n_processes=n_processes)
+    else:
+        # pdfium's render_to always starts a process pool, render page by page instead
+        renderer = (pdf.get_page(i).render_to(pdfium.BitmapConv.pil_image) for i in page_indices)
     for pg_num, image in zip(page_indices, renderer):
-        image.save(utils.joinPath(pdf2img_path, f"page-{pg_num}", ext=ext))
+        # pages are intermediate files, favour fast png encoding over file size
+        image.save(utils.joinPath(pdf2img_path, f"page-{pg_num}", ext=ext), compress_level=1)
 
 
-def rescaleBBoxes(img: Image, bboxes: list) -> list:
+def loadImage(img_dir: str) -> Image:
     """
-    Rescales the bounding boxes.
+    Decode a page image with libvips, which is faster and uses less memory
+    than PIL's decoder, then hand the pixels to PIL as an RGB image.
 
-    :param img: The document page, should be an Image
-    :param bboxes: The documents bounding boxes, should be a list[list[int | float]]
-    :return: bboxes - list[list[int | float]]
+    :param img_dir: Path to the page image, should be a str
+    :return: img - Image
+    """
+    vi = pyvips.Image.new_from_file(img_dir, access='sequential').colourspace('srgb')
+    if vi.hasalpha():
+        vi = vi.flatten(background=255)
+    vi = vi.cast('uchar')
+    arr = np.ndarray(buffer=vi.write_to_memory(), dtype=np.uint8, shape=[vi.height, vi.width, vi.bands])
+    return Image.fromarray(arr)
+
+
+@lru_cache(maxsize=None)
+def getOCREngine() -> RapidOCR:
+    """
+    Build the RapidOCR engine on first use, then reuse it for every
+    document. RapidOCR runs in process, which is much faster than the
+    LayoutLMv3 feature extractor's built-in Tesseract shell-out.
+
+    :return: ocr_engine - RapidOCR
     """
-    w_scale, h_scale = img.width / 1000, img.height / 1000
-    for box in bboxes:
-        box[0], box[2] = box[0] * w_scale, box[2] * w_scale
-        box[1], box[3] = box[1] * h_scale, box[3] * h_scale
-    return bboxes
+    return RapidOCR()
+
+
+def ocrPages(images: list) -> dict:
+    """
+    Extract the words and bounding boxes from each page with RapidOCR,
+    boxes are in pixel coordinates of the page.
+
+    :param images: The document pages, should be a list[Image]
+    :return: encoding - dict[str, list]
+    """
+    ocr_engine = getOCREngine()
+    encoding = {"words": [], "boxes": []}
+    for image in images:
+        result, _ = ocr_engine(np.asarray(image)[:, :, ::-1])  # RGB to BGR
+        result = result or []
+        # reduce the detected quadrilaterals to [x1, y1, x2, y2]
+        points = np.asarray([line[0] for line in result], dtype=np.float64).reshape(-1, 4, 2)
+        boxes = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+        encoding["words"].append([line[1] for line in result])
+        encoding["boxes"].append(boxes.tolist())
+    return encoding
+
+
+@numba.njit(parallel=True, cache=True)
+def drawBoxEdges(arr: np.ndarray, boxes: np.ndarray, colour: np.ndarray) -> None:
+    """
+    Compiled kernel that writes the four edges of each box into the image
+    array, edges are clipped to the image and boxes drawn in parallel.
+
+    :param arr: The page pixels, should be a np.ndarray[H, W, 3]
+    :param boxes: Bounding boxes in pixels, should be a np.ndarray[N, 4]
+    :param colour: Colour of the edges, should be a np.ndarray[3]
+    :return: None
+    """
+    height, width = arr.shape[0], arr.shape[1]
+    for i in numba.prange(boxes.shape[0]):
+        x1, y1, x2, y2 = boxes[i, 0], boxes[i, 1], boxes[i, 2], boxes[i, 3]
+        # clip the edges to the image, an edge is only drawn when it lies on the image
+        for x in range(max(x1, 0), min(x2, width - 1) + 1):
+            if 0 <= y1 < height:
+                arr[y1, x, :] = colour
+            if 0 <= y2 < height:
+                arr[y2, x, :] = colour
+        for y in range(max(y1, 0), min(y2, height - 1) + 1):
+            if 0 <= x1 < width:
+                arr[y, x1, :] = colour
+            if 0 <= x2 < width:
+                arr[y, x2, :] = colour
 
 
 def showBoxes(img, bboxes) -> Image:
@@ -93,10 +188,22 @@ def showBoxes(img, bboxes) -> Image:
     be a list[list[x1, y1, x2, y2]]
     :return img: Modified PIL.Image object
     """
-    # Draw bounding boxed onto the image
-    draw_object = ImageDraw.Draw(img)
-    for box in bboxes:
-        draw_object.rectangle(tuple(box), fill=None, outline='red')
+    # Draw bounding boxed onto the image, painting the box edges directly into the pixel array
+    arr = np.array(img)
+    boxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4).astype(np.int32)
+    drawBoxEdges(arr, boxes, np.array([255, 0, 0], dtype=np.uint8))
+    img.paste(Image.fromarray(arr))
+
+
+@lru_cache(maxsize=256)
+def getFont(fontsize: int) -> ImageFont.FreeTypeFont:
+    """
+    Load the Roboto font at the given size, each size is only loaded once.
+
+    :param fontsize: Size of the font, should be an int
+    :return: font - ImageFont.FreeTypeFont
+    """
+    return ImageFont.truetype("Roboto-Regular.ttf", fontsize)
 
 
 def displayText(raw_img_dims: tuple, bboxes: list, words: list, show_bboxes: bool = True) -> Image:
@@ -113,42 +220,42 @@ def displayText(raw_img_dims: tuple, bboxes: list, words: list, show_bboxes: boo
     """
     img = Image.new(size=raw_img_dims, mode="RGB", color=(255, 255, 255))
     draw = ImageDraw.Draw(img)
+    draw.fontmode = "1"  # black text on white, skip anti-aliasing
+    base_font = getFont(100)  # reference size for measuring words
+    outline = ImageColor.getrgb('red')  # resolve the colour once rather than per rectangle
+
+    # text length scales linearly with font size, fit each word to its box width
+    fontsizes = []
     for box, word in zip(bboxes, words):
-        fontsize = 1  # starting font size
-        font = ImageFont.truetype("Roboto-Regular.ttf", fontsize)
-        box_length = box[2] - box[0]
-        while font.getlength(word) < box_length:
-            fontsize += 1
-            font = ImageFont.truetype("Roboto-Regular.ttf", fontsize)
-        font = ImageFont.truetype("Roboto-Regular.ttf", fontsize-1)
-        draw.text((box[0], box[1]), word, (0, 0, 0), font=font)
-        if show_bboxes:
-            draw.rectangle(tuple(box), fill=None, outline='red')
+        base_length = base_font.getlength(word)
+        fontsizes.append(max(1, int(base_font.size * (box[2] - box[0]) / base_length)) if base_length else 1)
+
+    # draw the words grouped by font size, so consecutive calls reuse the same font
+    for i in sorted(range(len(fontsizes)), key=fontsizes.__getitem__):
+        box = bboxes[i]
+        draw.text((box[0], box[1]), words[i], (0, 0, 0), font=getFont(fontsizes[i]))
+    if show_bboxes:
+        for box in bboxes:
+            draw.rectangle(tuple(map(int, box)), fill=None, outline=outline)
     return img
 
 
-def exportJson(words, bboxes, output_file):
-    result = []
-    for i, box in enumerate(bboxes):
-        result.append({
-            "key": i,
-            "text": words[i],
-            "bbox": box
-        })
+def exportJson(words, bboxes, output_file, pretty: bool = False):
+    result = [{"key": i, "text": word, "bbox": box} for i, (word, box) in enumerate(zip(words, bboxes))]
 
-    with open(output_file, mode="w") as f:
-        json.dump(result, f, indent=4)
+    # indent only when the file is meant to be read by a person
+    with open(output_file, mode="wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2 if pretty else None))
 
 
 def testTransformers():
     # Document can be a png, jpg, etc. PDFs must be converted to images.
-    image = Image.open("test/invoice.png").convert("RGB")
+    image = loadImage("test/invoice.png")
 
-    feature_extractor = LayoutLMv3FeatureExtractor()
-    encoding = feature_extractor(image, do_resize=False, size={"width": image.width, "height": image.height})
+    encoding = ocrPages([image])
 
     page = 0
-    bboxes = rescaleBBoxes(image, encoding["boxes"][page])
+    bboxes = encoding["boxes"][page]
     showBoxes(image, bboxes)
     image.save("test/output.png")
 
@@ -167,28 +274,38 @@ def main():
 
     convertDataset(dataset_dir, results_dir, overwrite=False, ext='png')
 
-    for document_dir in utils.listPath(dataset_dir, ext=['pdf', 'PDF'], return_file_path=True)[1]:
-        document_name = utils.getLastPath(document_dir, include_ext=False)
-        outputs_dir = utils.makePath(results_dir, 'layoutml_outputs', document_name)
-        print("Processing document:", document_name)
-        for page_dir in utils.listPath(results_dir, 'pdf2img', document_name, return_file_path=True)[1]:
-            img_dir, exist = utils.checkPath(page_dir, ext='png')
-            if exist:
-                image = Image.open(img_dir).convert("RGB")
-
-                feature_extractor = LayoutLMv3FeatureExtractor()
-                encoding = feature_extractor(image, do_resize=False,
-                                             size={"width": image.width, "height": image.height})
-
-                page = 0  # scanning 1 page at a time
-                bboxes = rescaleBBoxes(image, encoding["boxes"][page])
+    # saving runs on background threads so it overlaps with the next document's OCR
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        saves = []
+        for document_dir in utils.listPath(dataset_dir, ext=['pdf', 'PDF'], return_file_path=True)[1]:
+            document_name = utils.getLastPath(document_dir, include_ext=False)
+            outputs_dir = utils.makePath(results_dir, 'layoutml_outputs', document_name)
+            print("Processing document:", document_name)
+            images, page_names = [], []
+            for page_dir in utils.listPath(results_dir, 'pdf2img', document_name, return_file_path=True)[1]:
+                img_dir, exist = utils.checkPath(page_dir, ext='png')
+                if exist:
+                    images.append(loadImage(img_dir))
+                    page_names.append(utils.getLastPath(img_dir, include_ext=False))
+            if not images:
+                continue
+
+            # scanning all pages of the document together
+            encoding = ocrPages(images)
+
+            for page, (image, page_name) in enumerate(zip(images, page_names)):
+                bboxes = encoding["boxes"][page]
                 showBoxes(image, bboxes)
-                image.save(utils.joinPath(outputs_dir, "bboxes_on_raw.png"))
+                saves.append(io_pool.submit(image.save, utils.joinPath(outputs_dir, f"{page_name}_bboxes_on_raw.png")))
 
                 text_img = displayText(image.size, bboxes, encoding['words'][page])
-                text_img.save(utils.joinPath(outputs_dir, "extracted_text.png"))
+                saves.append(io_pool.submit(text_img.save,
+                                            utils.joinPath(outputs_dir, f"{page_name}_extracted_text.png")))
 
-                exportJson(encoding['words'][page], bboxes, utils.joinPath(outputs_dir, "extracted_text.json"))
+                saves.append(io_pool.submit(exportJson, encoding['words'][page], bboxes,
+                                            utils.joinPath(outputs_dir, f"{page_name}_extracted_text.json")))
+        for future in saves:
+            future.result()  # surface any failed saves
 
 
 if __name__ == "__main__":
@@ -2,11 +2,87 @@ from __future__ import annotations
 
 import json
 import logging
+import mmap
 import os
 import pickle
+import shutil
+import sys
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePath
 from typing import Any
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
+
+_VALID_ERRORS = frozenset(("ignore", "warn", "raise"))
+_ERRORS_MSG = "The parameter errors must be either 'ignore', 'warn' or 'raise'"
+_SEPS = os.sep + (os.altsep or '')
+_MISSING = object()  # sentinel for attributes that do not exist
+_existing_paths = {}  # path -> time it was last seen to exist
+_BUFFER_SIZE = 1 << 20  # large buffers keep the number of reads and writes low on network filesystems
+_PICKLE_PROTOCOL = 5  # writes large buffers such as numpy arrays straight to the file without copying
+_MMAP_SIZE = 64 << 20  # pickles larger than this are loaded through a memory map
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only allows builtin containers, scalars and numpy
+    arrays, refusing any other global so untrusted pickles cannot run code.
+    """
+    safe_globals = frozenset([
+        *(('builtins', name) for name in ('bool', 'bytearray', 'bytes', 'complex', 'dict', 'float', 'frozenset',
+                                          'int', 'list', 'range', 'set', 'slice', 'str', 'tuple')),
+        ('collections', 'OrderedDict'), ('collections', 'defaultdict'),
+        ('datetime', 'date'), ('datetime', 'datetime'), ('datetime', 'time'), ('datetime', 'timedelta'),
+        ('numpy', 'dtype'), ('numpy', 'ndarray'),
+        # numpy 1 pickles arrays and scalars through numpy.core, numpy 2 through numpy._core
+        ('numpy.core.multiarray', '_reconstruct'), ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy.core.multiarray', 'scalar'), ('numpy._core.multiarray', 'scalar'),
+        ('numpy.core.numeric', '_frombuffer'), ('numpy._core.numeric', '_frombuffer'),
+    ])
+
+    def find_class(self, module: str, name: str) -> Any:
+        if (module, name) not in self.safe_globals:
+            raise pickle.UnpicklingError(f"Global '{module}.{name}' is not allowed by SafeUnpickler")
+        return super().find_class(module, name)
+
+
+def _report(msg: str, errors: str, exception: type = FileNotFoundError, warning: str = '') -> None:
+    """
+    Log the problem, then warn or raise the exception depending on errors.
+
+    :param msg: Message to log and raise with, should be a str
+    :param errors: Whether to 'ignore', 'warn' or 'raise' errors, should be str
+    :param exception: Exception raised for 'raise', should be a type
+    :param warning: Message to warn with instead of msg, should be a str
+    :return: None
+    """
+    logger.warning(msg)
+    if errors == 'warn':
+        # point at the first caller outside this module, however deep the utils calls are nested
+        stacklevel, frame = 1, sys._getframe(0)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            stacklevel, frame = stacklevel + 1, frame.f_back
+        warnings.warn(warning or msg, stacklevel=stacklevel)
+    elif errors == 'raise':
+        raise exception(msg)
+
 
 def checkPath(path_: str, *paths, ext: str = '', errors: str = 'ignore') -> tuple:
     """
@@ -19,23 +95,58 @@ def checkPath(path_: str, *paths, ext: str = '', errors: str = 'ignore') -> tupl
     :param errors: Whether to 'ignore', 'warn' or 'raise' errors, should be str
     :return: path_, exist - tuple[str, bool]
     """
-    if errors not in ["ignore", "warn", "raise"]:
-        raise ValueError("The parameter errors must be either 'ignore', 'warn' or 'raise'")
+    if errors not in _VALID_ERRORS:
+        raise ValueError(_ERRORS_MSG)
 
     path_ = joinPath(path_, *paths, ext=ext)
 
-    exist = True if os.path.exists(path_) else False
+    exist = pathExists(path_)
 
     if not exist and errors != 'ignore':
-        msg = f"No such file or directory: '{path_}'"
-        logging.warning(msg)
-        if errors == 'warn':
-            warnings.warn(msg)
-        elif errors == 'raise':
-            raise FileNotFoundError(msg)
+        _report(f"No such file or directory: '{path_}'", errors)
     return path_, exist
 
 
+def pathExists(path_: str, ttl: float = 2.0) -> bool:
+    """
+    Check if the path exists, paths that exist are remembered for ttl
+    seconds to skip repeated stat calls. Missing paths are always checked
+    again, so newly made files and folders are found straight away, while
+    deletes within ttl need clearPathCache.
+
+    :param path_: Path to a folder or file, should be a str
+    :param ttl: Seconds to trust a previous check, should be a float
+    :return: exist - bool
+    """
+    now = time.monotonic()
+    seen = _existing_paths.get(path_)
+    if seen is not None and now - seen < ttl:
+        return True
+
+    exist = os.path.exists(path_)
+    if exist:
+        if len(_existing_paths) >= 1024:
+            _existing_paths.clear()
+        _existing_paths[path_] = now
+    else:
+        _existing_paths.pop(path_, None)
+    return exist
+
+
+def clearPathCache(path_: str | None = None) -> None:
+    """
+    Forget the cached existence of a path, or of every path when none is
+    given, e.g. after deleting files outside of these utils.
+
+    :param path_: Path to a folder or file, should be a str | None
+    :return: None
+    """
+    if path_ is None:
+        _existing_paths.clear()
+    else:
+        _existing_paths.pop(path_, None)
+
+
 def joinPath(path_: str, *paths, ext: str = '') -> str:
     """
     Join the paths together, adds an extension if not already included
@@ -46,9 +157,24 @@ def joinPath(path_: str, *paths, ext: str = '') -> str:
     :param ext: File extension, should be a str
     :return: path_ - str
     """
-    path_, path_ext = os.path.splitext(os.path.join(path_, *paths))
-    if ext and path_ext != ext:
-        path_ext = (ext if ext and '.' in ext else f'.{ext}')
+    name = paths[0] if len(paths) == 1 else ''
+    # common folder + name case, without drives, roots or UNC shares, concatenating matches os.path.join
+    if name and path_ and name[0] not in _SEPS and ':' not in (path_[-1], name[1:2]) and path_[:2].strip(_SEPS):
+        path_ = path_ + name if path_[-1] in _SEPS else path_ + os.sep + name
+    else:
+        path_ = os.path.join(path_, *paths)
+    if not ext:
+        return path_
+
+    # same rules as os.path.splitext, a dot after the last separator that is not a leading dot
+    name_start = max(path_.rfind(os.sep), path_.rfind(os.altsep or os.sep)) + 1
+    dot = path_.rfind('.')
+    if dot > name_start and path_[name_start:dot].lstrip('.'):
+        path_, path_ext = path_[:dot], path_[dot:]
+    else:
+        path_ext = ''
+    if path_ext != ext:
+        path_ext = (ext if '.' in ext else f'.{ext}')
     return path_ + path_ext
 
 
@@ -62,9 +188,13 @@ def makePath(path_: str, *paths, errors: str = 'ignore') -> str:
     :return: path_ - str
     """
     path_, exist = checkPath(path_, *paths, errors=errors)
+    # a cached result may predate a delete, so confirm the path before skipping makedirs
+    if exist and not os.path.exists(path_):
+        clearPathCache(path_)
+        exist = False
     if not exist:
-        os.makedirs(path_)
-        logging.info(f"Path has been made: '{path_}'")
+        os.makedirs(path_, exist_ok=True)
+        logger.info("Path has been made: '%s'", path_)
     return path_
 
 
@@ -76,28 +206,30 @@ def listPath(path_: str, *paths, ext: str | list | tuple = '', return_file_path:
 
     :param path_: Main file path, should be a str
     :param paths: Remaining file paths, should be a tuple[str]
-    :param ext: File extension, should be a str | list | tuple
+    :param ext: File extension, ignoring case, should be a str | list | tuple
     :param return_file_path: Whether to return file name or file path, should be a bool
     :param errors: Whether to 'ignore', 'warn' or 'raise' errors, should be str
     :return: path_, files - tuple[str, list[str]]
     """
-    if errors not in ["ignore", "warn", "raise"]:
-        raise ValueError("The parameter errors must be either 'ignore', 'warn' or 'raise'")
+    if errors not in _VALID_ERRORS:
+        raise ValueError(_ERRORS_MSG)
 
     if isinstance(ext, str):
-        ext = ext.replace('.', '')
-    elif isinstance(ext, tuple) or isinstance(ext, list):
-        ext = [i.replace('.', '') for i in ext]
-    else:
+        ext = [ext] if ext else []
+    elif not isinstance(ext, tuple) and not isinstance(ext, list):
         raise TypeError(f"'ext': Expected type 'str', 'list' or 'tuple', got: '{type(ext).__name__}'")
+    # lower-case extensions for a case-insensitive constant time lookup per file
+    ext = frozenset(i.replace('.', '').lower() for i in ext)
 
     path_, exist = checkPath(path_, *paths, errors=errors)
 
     files = []
-    for file in os.listdir(path_):
-        file_ext = os.path.splitext(file)[1].replace('.', '')
-        if not ext or file_ext in ext:
-            files.append(joinPath(path_, file) if return_file_path else file)
+    with os.scandir(path_) as entries:
+        for entry in entries:
+            stem, _, file_ext = entry.name.rpartition('.')
+            # like os.path.splitext, leading dots are part of the name and not an extension
+            if not ext or (stem.strip('.') and file_ext.lower() in ext):
+                files.append(entry.path if return_file_path else entry.name)
     return path_, files
 
 
@@ -110,7 +242,7 @@ def sepPath(path_: str, direction: str = 'lr', max_split: int = 1) -> tuple:
     :param max_split: The splitting size, should be an int
     :return: left, right - tuple[str, str]
     """
-    sep_path = path_.split('\\')
+    sep_path = PurePath(path_).parts
     if max_split not in range(1, len(sep_path)):
         raise ValueError(f"'max_split' must be within range of 1 and directory depth, got: {max_split}")
 
@@ -120,7 +252,7 @@ def sepPath(path_: str, direction: str = 'lr', max_split: int = 1) -> tuple:
         left, right = sep_path[:(len(sep_path) - max_split)], sep_path[(len(sep_path) - max_split):]
     else:
         raise ValueError("The parameter direction must be either 'lr' or 'rl'")
-    return '\\'.join(left), '\\'.join(right)
+    return os.path.join(*left), os.path.join(*right)
 
 
 def getLastPath(path_: str, include_ext: bool = True) -> str:
@@ -132,7 +264,7 @@ def getLastPath(path_: str, include_ext: bool = True) -> str:
     :param include_ext: Whether to include file extension, should be a bool
     :return: last_path - str
     """
-    last_path = sepPath(path_, direction='rl', max_split=1)[1]
+    last_path = os.path.basename(path_)
     if not include_ext:
         return os.path.splitext(last_path)[0]
     return last_path
@@ -147,56 +279,96 @@ def update(obj: object, kwargs: dict) -> object:
     :param kwargs: Keywords and values to be updated, should be a dict
     :return: obj - object
     """
+    # plain instance attributes can be read and written through __dict__, skipping the attribute protocol
+    plain = type(obj).__getattribute__ is object.__getattribute__ and type(obj).__setattr__ is object.__setattr__
+    obj_dict = getattr(obj, '__dict__', None) if plain else None
     for key, value in kwargs.items():
-        if not hasattr(obj, key):
+        # only bypass getattr/setattr when no class attribute, such as a descriptor, shares the name
+        in_dict = obj_dict is not None and key in obj_dict and getattr(type(obj), key, _MISSING) is _MISSING
+        attr_ = obj_dict[key] if in_dict else getattr(obj, key, _MISSING)
+        if attr_ is _MISSING:
             raise AttributeError(f"'{obj.__class__.__name__}' object has no attribute '{key}'")
-        else:
-            attr_ = getattr(obj, key)
-            if isinstance(attr_, (type(value), type(None))) or value is None:
-                setattr(obj, key, value)
+        # exact type identity covers most updates, isinstance is only needed for subclasses
+        elif type(attr_) is type(value) or value is None or attr_ is None or isinstance(attr_, type(value)):
+            if in_dict:
+                obj_dict[key] = value
             else:
-                raise TypeError(f"'{key}': Expected type '{type(attr_).__name__}', got '{type(value).__name__}'")
+                setattr(obj, key, value)
+        else:
+            raise TypeError(f"'{key}': Expected type '{type(attr_).__name__}', got '{type(value).__name__}'")
     return obj
 
 
-def load(dir_: str, name: str, ext: str = '', errors: str = 'raise') -> Any:
+def load(dir_: str, name: str, ext: str = '', errors: str = 'raise', safe: bool = False,
+         binary: bool = False) -> Any:
     """
     Load the data with appropriate method. Pickle will deserialise the
-    contents of the file and json will load the contents.
+    contents of the file and json will load the contents, msgpack and npy
+    files are decoded without pickle and zpkl files are zstd compressed
+    pickles.
 
     :param dir_: Directory of file, should be a str
     :param name: Name of file, should be a str
     :param ext: File extension, should be a str
     :param errors: Whether to 'ignore', 'warn' or 'raise' errors, should be str
+    :param safe: Whether to only unpickle builtin types, should be a bool
+    :param binary: Whether to return txt files as undecoded bytes, should be a bool
     :return: data - Any
     """
-    if errors not in ["ignore", "warn", "raise"]:
-        raise ValueError("The parameter errors must be either 'ignore', 'warn' or 'raise'")
+    if errors not in _VALID_ERRORS:
+        raise ValueError(_ERRORS_MSG)
 
     if not ext:
         ext = os.path.splitext(name)[1]
 
     if not ext:
-        msg = f"The parameters 'name' or 'ext' must include file extension, got: '{name}', '{ext}'"
-        logging.warning(msg)
-        if errors == 'warn':
-            warnings.warn(f"Name '{name}' must include file extension")
-        elif errors == 'raise':
-            raise ValueError(msg)
+        _report(f"The parameters 'name' or 'ext' must include file extension, got: '{name}', '{ext}'", errors,
+                exception=ValueError, warning=f"Name '{name}' must include file extension")
         return
 
+    if binary and ext != '.txt':
+        raise ValueError(f"The parameter binary is only supported for '.txt' files, got: '{ext}'")
+
     path_, _ = checkPath(dir_, name, ext=ext, errors=errors)
 
     if ext == '.json':
-        with open(path_, 'r', encoding='utf-8') as file:
-            data = json.load(file)
+        with open(path_, 'rb', buffering=_BUFFER_SIZE) as file:
+            raw = file.read()
+        data = json.loads(raw)
+    elif ext == '.txt' and binary:
+        with open(path_, 'rb', buffering=0) as file:
+            data = file.read()  # a single unbuffered read, skipping the decode
     elif ext == '.txt':
-        with open(path_, 'r') as file:
+        with open(path_, 'r', buffering=_BUFFER_SIZE) as file:
             data = file.read()
+    elif ext == '.msgpack':
+        if msgpack is None:
+            raise ImportError("Loading '.msgpack' files requires the msgpack package")
+        with open(path_, 'rb', buffering=_BUFFER_SIZE) as file:
+            data = msgpack.unpack(file, raw=False, strict_map_key=False)  # accept the int keys save() writes
+    elif ext == '.npy':
+        if np is None:
+            raise ImportError("Loading '.npy' files requires the numpy package")
+        data = np.load(path_, allow_pickle=False)
+    elif ext == '.zpkl':
+        if zstd is None:
+            raise ImportError("Loading '.zpkl' files requires the zstandard package")
+        with open(path_, 'rb', buffering=_BUFFER_SIZE) as file, zstd.ZstdDecompressor().stream_reader(file) as reader:
+            data = SafeUnpickler(reader).load() if safe else pickle.load(reader)
     else:
-        with open(path_, 'rb') as file:
-            data = pickle.load(file)
-    logging.info(f"File '{name}' data was loaded")
+        with open(path_, 'rb', buffering=_BUFFER_SIZE) as file:
+            source = file
+            if os.fstat(file.fileno()).st_size > _MMAP_SIZE:
+                # read large pickles straight from the page cache rather than through a second buffer
+                source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    source.madvise(mmap.MADV_SEQUENTIAL)
+            try:
+                data = SafeUnpickler(source).load() if safe else pickle.load(source)
+            finally:
+                if source is not file:
+                    source.close()
+    logger.info("File '%s' data was loaded", name)
     return data
 
 
@@ -204,7 +376,8 @@ def save(dir_: str, name: str, data: Any, indent: int = 4, errors: str = 'raise'
     """
     Save the data with appropriate method. Pickle will serialise the
     object, while json will dump the data with indenting to allow users
-    to edit and easily view the encoded data.
+    to edit and easily view the encoded data, msgpack and npy files are
+    encoded without pickle and zpkl files are zstd compressed pickles.
 
     :param dir_: Directory of file, should be a str
     :param name: Name of file, should be a str
@@ -213,44 +386,92 @@ def save(dir_: str, name: str, data: Any, indent: int = 4, errors: str = 'raise'
     :param errors: If 'ignore', suppress errors, should be str
     :return: completed - bool
     """
-    if errors not in ["ignore", "warn", "raise"]:
-        raise ValueError("The parameter errors must be either 'ignore', 'warn' or 'raise'")
+    if errors not in _VALID_ERRORS:
+        raise ValueError(_ERRORS_MSG)
+
+    if not os.path.isdir(dir_):
+        _report(f"No such file or directory: '{dir_}'", errors)
+        return False
 
     path_ = joinPath(dir_, name)
     ext = os.path.splitext(name)[1]
 
-    checkPath(dir_, errors=errors)
-    if not os.path.exists(dir_):
-        msg = f"No such file or directory: '{dir_}'"
-        logging.warning(msg)
-        if errors == 'warn':
-            warnings.warn(msg)
-        elif errors == 'raise':
-            raise FileNotFoundError(msg)
-        return False
-
     if not ext:
-        logging.warning(f"File '{name}' must include file extension in name")
+        logger.warning("File '%s' must include file extension in name", name)
         if errors == 'raise':
             warnings.warn(f"File '{name}' must include file extension in name")
         return False
 
     if ext == '.json':
-        with open(path_, 'w', encoding='utf-8') as file:
-            json.dump(data, file, indent=indent)
+        encoded = json.dumps(data, indent=indent)  # encode in memory, then write once
+        with open(path_, 'w', encoding='utf-8', buffering=_BUFFER_SIZE) as file:
+            file.write(encoded)
     elif ext == '.txt':
-        with open(path_, 'w') as file:
+        with open(path_, 'w', buffering=_BUFFER_SIZE) as file:
             file.write(str(data))
+    elif ext == '.msgpack':
+        if msgpack is None:
+            raise ImportError("Saving '.msgpack' files requires the msgpack package")
+        with open(path_, 'wb', buffering=_BUFFER_SIZE) as file:
+            msgpack.pack(data, file, use_bin_type=True)
+    elif ext == '.npy':
+        if np is None:
+            raise ImportError("Saving '.npy' files requires the numpy package")
+        np.save(path_, data, allow_pickle=False)
+    elif ext == '.zpkl':
+        if zstd is None:
+            raise ImportError("Saving '.zpkl' files requires the zstandard package")
+        # compress the pickle stream on all cores, fewer bytes hit the disk
+        with open(path_, 'wb', buffering=_BUFFER_SIZE) as file, \
+                zstd.ZstdCompressor(level=3, threads=-1).stream_writer(file) as writer:
+            pickle.dump(data, writer, _PICKLE_PROTOCOL)
     elif isinstance(data, object):
-        with open(path_, 'wb') as file:
-            pickle.dump(data, file, pickle.HIGHEST_PROTOCOL)
+        with open(path_, 'wb', buffering=_BUFFER_SIZE) as file:
+            pickle.dump(data, file, _PICKLE_PROTOCOL)
     else:
-        msg = f"Saving method was not determined, failed to save file, got: {type(data)}"
-        logging.warning(msg)
-        if errors == 'warn':
-            warnings.warn(msg)
-        elif errors == 'raise':
-            raise FileNotFoundError(msg)
+        _report(f"Saving method was not determined, failed to save file, got: {type(data)}", errors)
         return False
-    logging.info(f"File '{name}' was saved")
+    logger.info("File '%s' was saved", name)
     return True
+
+
+def copy(src: str, dst: str) -> None:
+    """
+    Copy a file, shutil uses os.sendfile on Linux so the bytes are copied
+    inside the kernel, falling back to read/write where it is unsupported.
+
+    :param src: Path of the file to copy, should be a str
+    :param dst: Path to copy the file to, should be a str
+    :return: None
+    """
+    shutil.copyfile(src, dst)
+
+
+def loadMany(specs: list, max_workers: int | None = None, **kwargs) -> list:
+    """
+    Load several files at once on a thread pool, file reads release the
+    GIL so the loads overlap on slow storage.
+
+    :param specs: Directory and name of each file, should be a list[tuple[str, str]]
+    :param max_workers: Number of files to load at once, should be an int | None
+    :param kwargs: Keywords and values to be passed to load
+    :return: data - list[Any]
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda spec: load(*spec, **kwargs), specs))
+
+
+def saveMany(items: list, max_workers: int | None = None, **kwargs) -> list:
+    """
+    Save several files at once on a thread pool, file writes release the
+    GIL so the saves overlap on slow storage.
+
+    :param items: Directory, name and data of each file, should be a list[tuple[str, str, Any]]
+    :param max_workers: Number of files to save at once, should be an int | None
+    :param kwargs: Keywords and values to be passed to save
+    :return: completed - list[bool]
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda item: save(*item, **kwargs), items))